@@ -1,10 +1,11 @@
-from typing import List, Literal
+from typing import Dict, List, Literal, Optional, Tuple
 import argparse
 import pathlib
 
 import easyidp as idp
-import pandas as pd
+import numpy as np
 import geopandas as gpd
+import shapely
 
 import tile_ortho
 
@@ -14,22 +15,37 @@ def main(
     tile_images_dir: pathlib.Path,
     tiles_shapefile: pathlib.Path,
     outfile: pathlib.Path,
-    shape: Literal["rectangle", "oval"] = "rectangle"
+    shape: Literal["rectangle", "oval"] = "rectangle",
+    outer_tiles_shapefile: Optional[pathlib.Path] = None,
 ):
 
-    tiles_gdf = gpd.read_file(tiles_shapefile)
+    tiles_gdf = tile_ortho.read_tiles(tiles_shapefile)
+    crs = tiles_gdf.crs
 
-    polygons_gdf_parts: List[gpd.GeoDataFrame] = []
-    for _, tile in tiles_gdf.iterrows():
-        tile_id = tile["tile_id"]
+    # Bounds of the tile images. Taken from the outer tiles if available,
+    # otherwise read from each GeoTIFF header.
+    outer_bounds: Dict[str, Tuple[float, float, float, float]] = {}
+    if outer_tiles_shapefile is not None:
+        outer_gdf = tile_ortho.read_tiles(outer_tiles_shapefile)
+        outer_bounds = dict(zip(
+            outer_gdf["tile_id"].to_numpy(),
+            map(tuple, shapely.bounds(outer_gdf.geometry.to_numpy())),
+        ))
+
+    all_classes: List[int] = []
+    all_polygons: List[shapely.geometry.Polygon] = []
+    tile_ids = tiles_gdf["tile_id"].to_numpy()
+    tiles_inner = tiles_gdf.geometry.values
+    for tile_id, tile_inner in zip(tile_ids, tiles_inner):
         geotiff_path = tile_images_dir/f"tile_{tile_id}.tif"
         labels_path = yolo_labels_dir/f"tile_{tile_id}.txt"
         if not (geotiff_path.exists() and labels_path.exists()):
             continue
-        tile_inner = tile["geometry"]
-        orthophoto = idp.geotiff.GeoTiff(str(geotiff_path))
-        crs = orthophoto.crs
-        bounds = tile_ortho.geotiff_bounds(orthophoto)
+        if tile_id in outer_bounds:
+            bounds = outer_bounds[tile_id]
+        else:
+            bounds = tile_ortho.geotiff_bounds(
+                idp.geotiff.GeoTiff(str(geotiff_path)))
         if shape == "oval":
             classes, polygons = (
                 tile_ortho.ovals_from_yolo_output(labels_path, bounds))
@@ -39,21 +55,21 @@ def main(
         else:
             raise ValueError(
                 f"Shape should be rectangle or oval. Got {shape} instead.")
-        polygons_gdf_part = gpd.GeoDataFrame(
-            data={"class": classes}, 
-            geometry=polygons, 
-            crs=crs
-        )
-        centroids = polygons_gdf_part.centroid.clip(tile_inner)
-        polygons_gdf_part_clipped = polygons_gdf_part.loc[centroids.index, :]
-        polygons_gdf_parts.append(polygons_gdf_part_clipped)
+        # Keep the detections whose centroid lies within the inner tile
+        polygons_array = np.fromiter(
+            polygons, dtype=object, count=len(polygons))
+        centroids = shapely.centroid(polygons_array)
+        mask = shapely.contains(tile_inner, centroids)
+        all_classes.extend(np.asarray(classes, dtype=int)[mask].tolist())
+        all_polygons.extend(polygons_array[mask].tolist())
 
-    polygons_gdf = gpd.GeoDataFrame(pd.concat(
-        polygons_gdf_parts, 
-        ignore_index=True
-    ))
+    polygons_gdf = gpd.GeoDataFrame(
+        data={"class": all_classes}, 
+        geometry=all_polygons, 
+        crs=crs
+    )
 
-    polygons_gdf.to_file(outfile, mode="w")
+    polygons_gdf.to_file(outfile, mode="w", engine="pyogrio")
 
 
 if __name__ == "__main__":
@@ -66,7 +82,10 @@ if __name__ == "__main__":
     parser.add_argument("--tile-images-dir", 
                         help="original images folder", required=True)
     parser.add_argument("--tiles-shapefile", 
-                        help="inner tiles shapefile", required=True)
+                        help="inner tiles file (GeoParquet or shapefile)", 
+                        required=True)
+    parser.add_argument("--outer-tiles-shapefile", 
+                        help="outer tiles file (optional)")
     parser.add_argument("--outfile", 
                         help="output shapefile", required=True)
     parser.add_argument("--shape",
@@ -79,6 +98,10 @@ if __name__ == "__main__":
     yolo_labels_dir=pathlib.Path(args.yolo_labels_dir)
     tile_images_dir=pathlib.Path(args.tile_images_dir)
     tiles_shapefile=pathlib.Path(args.tiles_shapefile)
+    outer_tiles_shapefile=(
+        pathlib.Path(args.outer_tiles_shapefile)
+        if args.outer_tiles_shapefile else None
+    )
     outfile=pathlib.Path(args.outfile)
 
     # Call main function
@@ -88,4 +111,5 @@ if __name__ == "__main__":
         tiles_shapefile=tiles_shapefile,
         outfile=outfile,
         shape=args.shape,
+        outer_tiles_shapefile=outer_tiles_shapefile,
     )
\ No newline at end of file
@@ -8,6 +8,7 @@ import geopandas as gpd
 import pathlib
 import easyidp as idp
 import os
+import shapely
 
 import tile_ortho
 
@@ -34,11 +35,18 @@ def main(
     # ============
     orthophoto = idp.geotiff.GeoTiff(str(orthophoto_path))
     bounds = tile_ortho.geotiff_bounds(orthophoto)
-    bboxes_ref = gpd.read_file(bboxes_ref_path, bbox=tuple(bounds))
+    bboxes_ref = gpd.read_file(
+        bboxes_ref_path, 
+        bbox=tuple(bounds),
+        engine="pyogrio",
+        use_arrow=True,
+    )
     bboxes_ref["point"] = bboxes_ref.centroid
     split_areas = gpd.read_file(
         split_shapefile_path, 
-        bbox=tuple(bounds)
+        bbox=tuple(bounds),
+        engine="pyogrio",
+        use_arrow=True,
     ).clip(bounds)
 
     # Convert all to the same coordinate reference system (CRS)
@@ -47,12 +55,22 @@ def main(
     logging.info(f"CRS of {bboxes_ref_path}: {bboxes_ref.crs}")
     logging.info(f"CRS of {split_shapefile_path}: {split_areas.crs}")
     crs: Any = orthophoto.crs
-    bboxes_ref = bboxes_ref.to_crs(crs)
-    split_areas = split_areas.to_crs(crs)
-    logging.info(
-        f"Transformed bounding boxes and split areas to use the same CRS as "
-        f"the orthophoto ({crs})."
-    )
+    if bboxes_ref.crs != crs:
+        bboxes_ref = bboxes_ref.to_crs(crs)
+        logging.info(
+            f"Transformed bounding boxes to use the same CRS as the "
+            f"orthophoto ({crs})."
+        )
+    else:
+        logging.info(f"Bounding boxes already in orthophoto CRS ({crs}).")
+    if split_areas.crs != crs:
+        split_areas = split_areas.to_crs(crs)
+        logging.info(
+            f"Transformed split areas to use the same CRS as the "
+            f"orthophoto ({crs})."
+        )
+    else:
+        logging.info(f"Split areas already in orthophoto CRS ({crs}).")
 
     # Split into overlapping tiles
     # ============================
@@ -75,22 +93,31 @@ def main(
         geometry="tile_inner",
         crs=crs,
     )
-    tiles_gdf["tile_outer"] = tiles_gdf["tile_inner"].buffer(
-        distance = buffer_m,
-        join_style = 2,   
-    ).clip(bounds)
+    tiles_gdf["tile_outer"] = gpd.GeoSeries(
+        shapely.clip_by_rect(
+            shapely.buffer(
+                tiles_gdf["tile_inner"].to_numpy(), 
+                buffer_m, 
+                join_style="mitre",
+            ),
+            *bounds,
+        ),
+        index=tiles_gdf.index,
+        crs=crs,
+    )
 
     # Create outdir
     # =============
     tile_ortho.make_or_replace_dir(outdir)
-    for split in tiles_gdf["split"].unique():
+    split_names = tiles_gdf["split"].unique().tolist()
+    for split in split_names:
         (outdir / f"images/{split}").mkdir(parents=True)
         (outdir / f"labels/{split}").mkdir(parents=True)
 
     # Save data description YAML
     # ==========================
     data_yaml = {}
-    for split in tiles_gdf["split"].unique():
+    for split in split_names:
         data_yaml[split] = f"images/{split}"
     data_yaml["nc"] = 4
     data_yaml["names"] = ["healthy", "infected", "dead", "non-spruce"]
@@ -99,25 +126,52 @@ def main(
 
     # Save dataset in YOLO format
     # ===========================
-    for _, row in tiles_gdf.iterrows():
-        tile_id = row["tile_id"]
-        tile = row["tile_outer"]
-        tile_coords = np.array(tile.boundary.coords)
-        split = row["split"]
-        save_path = outdir/"images"/split/f"tile_{tile_id}.tif"
-        orthophoto.crop_polygon(
-            polygon_hv=tile_coords,
-            is_geo=True,
-            save_path=save_path, 
+    tile_ids = tiles_gdf["tile_id"].to_numpy()
+    tiles = tiles_gdf["tile_outer"].values
+    splits = tiles_gdf["split"].to_numpy()
+    tile_ortho.crop_tiles(
+        orthophoto_path,
+        tile_coords=tile_ortho.exterior_coords(tiles),
+        save_paths=[
+            outdir/"images"/split/f"tile_{tile_id}.tif"
+            for tile_id, split in zip(tile_ids, splits)
+        ],
+    )
+    # Find all intersecting (tile, tree) pairs with one spatial index query
+    # and clip the trees to the tiles, instead of clipping the whole dataset
+    # for each tile
+    ref_geometries = bboxes_ref.geometry.to_numpy()
+    # Classes can be text (e.g. "spruce"), so they are kept in their own
+    # object array and only formatted when writing the labels
+    ref_classes = bboxes_ref["class"].to_numpy(dtype=object)
+    ref_tree = shapely.STRtree(ref_geometries)
+    tiles_array = np.asarray(tiles, dtype=object)
+    tile_idx, tree_idx = ref_tree.query(tiles_array, predicate="intersects")
+    # Group the pairs by tile, keeping the trees in their original order
+    order = np.lexsort((tree_idx, tile_idx))
+    tile_idx = tile_idx[order]
+    tree_idx = tree_idx[order]
+    clipped = shapely.intersection(
+        ref_geometries[tree_idx], tiles_array[tile_idx])
+    keep = ~shapely.is_empty(clipped)
+    tile_idx = tile_idx[keep]
+    clipped_bounds = shapely.bounds(clipped[keep])
+    clipped_classes = ref_classes[tree_idx[keep]]
+    # Rows of each tile are contiguous, so they can be sliced out
+    counts = np.bincount(tile_idx, minlength=len(tiles_array))
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    for tile_id, tile, split, start, end in zip(
+            tile_ids, tiles, splits, starts, ends):
+        lines = tile_ortho.convert_to_yolo_format_array(
+            clipped_bounds[start:end], 
+            tile.bounds, 
+            clipped_classes[start:end],
         )
-        tile_ortho.replace_geotiff_alpha(save_path, save_path)
-        for _, tree in bboxes_ref.clip(tile).iterrows():
-            bbox = tree["geometry"].bounds
-            class_id = tree["class"] 
-            yolo_format = tile_ortho.convert_to_yolo_format(
-                bbox, tile.bounds, class_id)
-            with open(outdir/"labels"/split/f"tile_{tile_id}.txt", 'a') as f:
-                f.write(yolo_format + "\n")
+        # Whole file in one write
+        labels_path = outdir/"labels"/split/f"tile_{tile_id}.txt"
+        labels_path.write_bytes(
+            "".join(line + "\n" for line in lines).encode())
 
 
 if __name__ == "__main__":
@@ -1,12 +1,12 @@
-from typing import Any, Union
+from typing import Any, Literal, Union
 import argparse
 import logging
 import os
 
-import numpy as np
 import geopandas as gpd
 import pathlib
 import easyidp as idp
+import shapely
 
 import tile_ortho
 
@@ -17,6 +17,7 @@ def main(
     max_tile_size_px: int,
     buffer_m: float,
     outdir: Union[os.PathLike, str],
+    tiles_format: Literal["parquet", "shapefile"] = "parquet",
 ):
     
     # Parameters
@@ -35,7 +36,9 @@ def main(
     bounds = tile_ortho.geotiff_bounds(orthophoto)
     areas = gpd.read_file(
         shapefile_path, 
-        bbox=tuple(bounds)
+        bbox=tuple(bounds),
+        engine="pyogrio",
+        use_arrow=True,
     ).clip(bounds)
 
     # Convert all to the same coordinate reference system (CRS)
@@ -43,11 +46,14 @@ def main(
     logging.info(f"CRS of {orthophoto_path}: {orthophoto.crs}")
     logging.info(f"CRS of {shapefile_path}: {areas.crs}")
     crs: Any = orthophoto.crs
-    areas = areas.to_crs(crs)
-    logging.info(
-        f"Transformed bounding boxes and split areas to use the same CRS as "
-        f"the orthophoto ({crs})."
-    )
+    if areas.crs != crs:
+        areas = areas.to_crs(crs)
+        logging.info(
+            f"Transformed areas to use the same CRS as the orthophoto "
+            f"({crs})."
+        )
+    else:
+        logging.info(f"Areas already in orthophoto CRS ({crs}).")
 
     # Split into overlapping tiles
     # ============================
@@ -78,10 +84,18 @@ def main(
         geometry="inner_tile",
         crs=crs,
     )
-    tiles["outer_tile"] = tiles["inner_tile"].buffer(
-        distance = buffer_m,
-        join_style = 2,   
-    ).clip(bounds)
+    tiles["outer_tile"] = gpd.GeoSeries(
+        shapely.clip_by_rect(
+            shapely.buffer(
+                tiles["inner_tile"].to_numpy(), 
+                buffer_m, 
+                join_style="mitre",
+            ),
+            *bounds,
+        ),
+        index=tiles.index,
+        crs=crs,
+    )
 
     # Create outdir
     # =============
@@ -93,25 +107,35 @@ def main(
     
     # Save cropped images
     # ===================
-    for _, row in tiles.iterrows():
-        tile_id = row["tile_id"]
-        tile = row["outer_tile"]
-        tile_coords = np.array(tile.boundary.coords)
-        split = row["split"]
-        save_path = outdir/"images"/split/f"tile_{tile_id}.tif"
-        orthophoto.crop_polygon(
-            polygon_hv=tile_coords,
-            is_geo=True,
-            save_path=save_path, 
-        )
-        tile_ortho.replace_geotiff_alpha(save_path, save_path)
+    tile_ids = tiles["tile_id"].to_numpy()
+    outer_tiles = tiles["outer_tile"].values
+    splits = tiles["split"].to_numpy()
+    tile_ortho.crop_tiles(
+        orthophoto_path,
+        tile_coords=tile_ortho.exterior_coords(outer_tiles),
+        save_paths=[
+            outdir/"images"/split/f"tile_{tile_id}.tif"
+            for tile_id, split in zip(tile_ids, splits)
+        ],
+    )
     
-    # Save tiles as a shapefile (so the inner tiles can be accessed later)
-    # =========================
+    # Save tiles as GeoParquet or shapefile (so the inner tiles can be
+    # accessed later)
+    # ===================================================================
     tiles_inner = tiles.drop(columns=["outer_tile"])
     tiles_outer = tiles.set_geometry("outer_tile").drop(columns=["inner_tile"])
-    tiles_inner.to_file(outdir_shapefiles/"tiles_inner.shp")
-    tiles_outer.to_file(outdir_shapefiles/"tiles_outer.shp")
+    if tiles_format == "parquet":
+        tiles_inner.to_parquet(outdir_shapefiles/"tiles_inner.parquet")
+        tiles_outer.to_parquet(outdir_shapefiles/"tiles_outer.parquet")
+    elif tiles_format == "shapefile":
+        tiles_inner.to_file(
+            outdir_shapefiles/"tiles_inner.shp", engine="pyogrio")
+        tiles_outer.to_file(
+            outdir_shapefiles/"tiles_outer.shp", engine="pyogrio")
+    else:
+        raise ValueError(
+            f"Tiles format should be parquet or shapefile. "
+            f"Got {tiles_format} instead.")
 
 
 if __name__ == "__main__":
@@ -124,6 +148,10 @@ if __name__ == "__main__":
     parser.add_argument("--outdir", help="output directory", required=True)
     parser.add_argument("--max-tile-size", help="max tile side length in pixels", required=True)
     parser.add_argument("--buffer-meters", help="amount of overlap in metres", required=True)
+    parser.add_argument("--tiles-format",
+                        help="file format of the saved tiles",
+                        choices=["parquet", "shapefile"],
+                        default="parquet")
 
     args = parser.parse_args()
 
@@ -139,4 +167,5 @@ if __name__ == "__main__":
         max_tile_size_px=int(args.max_tile_size),
         buffer_m=float(args.buffer_meters),
         outdir=outdir, 
+        tiles_format=args.tiles_format,
     )
\ No newline at end of file
@@ -1,4 +1,5 @@
-from typing import Any, Iterable, List, Tuple, Union
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+from concurrent.futures import ProcessPoolExecutor
 import math
 import itertools
 import pathlib
@@ -10,8 +11,18 @@ from numpy.typing import NDArray
 import geopandas as gpd
 import easyidp as idp
 import rasterio
+import rasterio.features
+import rasterio.windows
 import shapely
 
+# Use pyogrio for all vector I/O; it reads and writes whole columns at a time
+# instead of one feature at a time like Fiona.
+gpd.options.io_engine = "pyogrio"
+
+# Creation options for tile images. Tiles are small and read right away by
+# YOLO, so compressing them costs more time than it saves.
+TILE_CREATION_OPTIONS = {"compress": "none"}
+
 
 def geotiff_bounds(
         geotiff: idp.geotiff.GeoTiff
@@ -28,6 +39,34 @@ def geotiff_bounds(
     return tuple(array.flatten().tolist())
 
 
+def whiten_transparent(
+        data: NDArray,
+        mask: Optional[NDArray] = None,
+) -> NDArray:
+    """Convert RGB(A) image data to RGB with transparent pixels white.
+
+    `data` has shape `(bands, height, width)`; with 4 bands the last one is
+    assumed to be alpha. Pixels where the optional boolean `mask` is `True`
+    are also made white. `data` is modified in place.
+    """
+    if data.shape[0] == 4:
+        # Assume last band is alpha
+        rgb_data = data[:3]
+        white = data[3] == 0
+        if mask is not None:
+            white |= mask
+    elif data.shape[0] == 3:
+        # No alpha channel
+        rgb_data = data
+        white = mask
+    else:
+        raise ValueError(f"Unsupported band count: {data.shape[0]}")
+
+    if white is not None:
+        rgb_data[:, white] = 255
+    return rgb_data
+
+
 def replace_geotiff_alpha(
         input_path: Union[os.PathLike, str], 
         output_path: Union[os.PathLike, str]
@@ -37,56 +76,169 @@ def replace_geotiff_alpha(
     with rasterio.open(input_path) as src:
         profile = src.profile
         data = src.read()  # shape: (bands, height, width)
+        rgb_data = whiten_transparent(data)
+        profile.update(dtype=rgb_data.dtype, count=3)
 
-        if src.count == 4:
-            # Assume last band is alpha
-            r, g, b, a = data
-            alpha_mask = a == 0
+    with rasterio.open(output_path, 'w', **profile) as dst:
+        dst.write(rgb_data)
 
-            # Replace transparent pixels with white
-            r[alpha_mask] = 255
-            g[alpha_mask] = 255
-            b[alpha_mask] = 255
 
-            rgb_data = np.stack([r, g, b])
-            profile.update(count=3)
-        elif src.count == 3:
-            # No alpha channel
-            rgb_data = data
-        else:
-            raise ValueError(f"Unsupported band count: {src.count}")
+_open_rasters: Dict[str, rasterio.DatasetReader] = {}
 
-        profile.update(dtype=rgb_data.dtype, count=3)
 
-    with rasterio.open(output_path, 'w', **profile) as dst:
+def _open_raster(path: str) -> rasterio.DatasetReader:
+    """Open a geotiff once per process and reuse it for later calls.
+
+    Only the most recently used geotiff is kept open, the previous one is
+    closed when another path is requested.
+    """
+    if path not in _open_rasters:
+        for src in _open_rasters.values():
+            src.close()
+        _open_rasters.clear()
+        _open_rasters[path] = rasterio.open(path, sharing=True)
+    return _open_rasters[path]
+
+
+def crop_tile(
+        orthophoto_path: Union[os.PathLike, str],
+        tile_coords: NDArray,
+        save_path: Union[os.PathLike, str],
+) -> None:
+    """Crop a polygon from an orthophoto and save it with a white background.
+
+    Equivalent to cropping and then calling `replace_geotiff_alpha`, but the
+    tile is written only once.
+
+    The orthophoto is opened here rather than passed in, so that this can be
+    run in a worker process. `tile_coords` is the exterior ring of the tile
+    polygon in geographic coordinates. Only the window covering the tile is
+    read from the orthophoto.
+    """
+    src = _open_raster(str(orthophoto_path))
+    min_x, min_y = tile_coords.min(axis=0)
+    max_x, max_y = tile_coords.max(axis=0)
+    window = rasterio.windows.from_bounds(
+        min_x, min_y, max_x, max_y, transform=src.transform
+    ).round_offsets().round_lengths()
+    transform = src.window_transform(window)
+    # Outer tiles are clipped to the orthophoto bounds, so the window fits.
+    # A boundless read goes through a VRT that reopens the file, so it is
+    # only used if pixel snapping pushed the window past the edge.
+    fits = (
+        window.col_off >= 0 and window.row_off >= 0
+        and window.col_off + window.width <= src.width
+        and window.row_off + window.height <= src.height
+    )
+    if fits:
+        data = src.read(window=window)
+    else:
+        data = src.read(window=window, boundless=True, fill_value=255)
+
+    # Pixels outside the tile polygon are made white
+    outside = rasterio.features.geometry_mask(
+        [{"type": "Polygon", "coordinates": [tile_coords.tolist()]}],
+        out_shape=data.shape[1:],
+        transform=transform,
+    )
+    rgb_data = whiten_transparent(data, mask=outside)
+
+    # Only the georeferencing is taken from the orthophoto, not its creation
+    # options (photometric, nodata, block size, ...)
+    profile = dict(
+        driver="GTiff",
+        height=rgb_data.shape[1],
+        width=rgb_data.shape[2],
+        count=3,
+        dtype=rgb_data.dtype,
+        crs=src.crs,
+        transform=transform,
+    )
+    profile.update(TILE_CREATION_OPTIONS)
+    with rasterio.open(save_path, 'w', **profile) as dst:
         dst.write(rgb_data)
 
 
+def crop_tiles(
+        orthophoto_path: Union[os.PathLike, str],
+        tile_coords: Sequence[NDArray],
+        save_paths: Sequence[Union[os.PathLike, str]],
+        max_workers: Optional[int] = None,
+) -> None:
+    """Crop many tiles from an orthophoto in parallel, see `crop_tile`."""
+    workers = max_workers or os.cpu_count() or 1
+    chunksize = max(1, len(save_paths) // (4 * workers))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Consume the results so that errors in workers are raised here
+        list(executor.map(
+            crop_tile,
+            itertools.repeat(orthophoto_path),
+            tile_coords,
+            save_paths,
+            chunksize=chunksize,
+        ))
+
+
+def exterior_coords(polygons: Sequence[shapely.Polygon]) -> List[NDArray]:
+    """Get the exterior ring coordinates of many polygons at once.
+
+    Returns a list with a `(n_vertices, 2)` array for each polygon.
+    """
+    rings = shapely.get_exterior_ring(np.asarray(polygons, dtype=object))
+    coords, index = shapely.get_coordinates(rings, return_index=True)
+    counts = np.bincount(index, minlength=len(rings))
+    return np.split(coords, np.cumsum(counts)[:-1])
+
+
 def get_tiles(
     areas: gpd.GeoDataFrame, 
     max_tile_width_m: float, 
     max_tile_height_m: float,
 ) -> Iterable[tuple[Any, ...]]:
-    for _, row in areas.iterrows():
-        min_x, min_y, max_x, max_y = row.geometry.bounds
+    # Plain tuples; the geometry is assumed to be the last column
+    for row in areas.itertuples(index=False, name=None):
+        *fields, geometry = row
+        min_x, min_y, max_x, max_y = geometry.bounds
         width = max_x - min_x
         height = max_y - min_y
         n_cols = math.ceil(width / max_tile_width_m)
         n_rows = math.ceil(height / max_tile_height_m)
         tile_width_m = width / n_cols
         tile_height_m = height / n_rows
-        fields = row.iloc[:-1].to_list()
-        for (i, j) in itertools.product(range(n_cols), range(n_rows)):
-            tile = shapely.geometry.box(
-                min_x + i * tile_width_m, 
-                min_y + j * tile_height_m,
-                min_x + (i + 1) * tile_width_m,
-                min_y + (j + 1) * tile_height_m,
-            ).intersection(row.geometry)
-            min_x_rounded = int(min_x + i * tile_width_m)
-            min_y_rounded = int(min_y + j * tile_height_m)
-            tile_id = f"{min_x_rounded}_{min_y_rounded}"
-            yield tile_id, *fields, tile 
+        # All tiles of the area at once, in the same column-major order as
+        # itertools.product(range(n_cols), range(n_rows))
+        i, j = np.meshgrid(np.arange(n_cols), np.arange(n_rows), indexing="ij")
+        i = i.ravel()
+        j = j.ravel()
+        tile_min_x = min_x + i * tile_width_m
+        tile_min_y = min_y + j * tile_height_m
+        boxes = shapely.box(
+            tile_min_x,
+            tile_min_y,
+            min_x + (i + 1) * tile_width_m,
+            min_y + (j + 1) * tile_height_m,
+        )
+        tiles = shapely.intersection(boxes, geometry)
+        tile_ids = [
+            f"{min_x_rounded}_{min_y_rounded}"
+            for min_x_rounded, min_y_rounded in zip(
+                tile_min_x.astype(int).tolist(),
+                tile_min_y.astype(int).tolist(),
+            )
+        ]
+        for tile_id, tile in zip(tile_ids, tiles):
+            yield tile_id, *fields, tile
+
+
+def read_tiles(tiles_path: Union[os.PathLike, str]) -> gpd.GeoDataFrame:
+    """Read a tiles file written by the tile orthophoto script.
+
+    GeoParquet is used for `.parquet` files, anything else is read with
+    pyogrio (e.g. shapefiles).
+    """
+    if pathlib.Path(tiles_path).suffix == ".parquet":
+        return gpd.read_parquet(tiles_path)
+    return gpd.read_file(tiles_path, engine="pyogrio", use_arrow=True)
 
 
 def make_or_replace_dir(dir_path: pathlib.Path):
@@ -97,28 +249,43 @@ def make_or_replace_dir(dir_path: pathlib.Path):
     dir_path.mkdir(parents=True)
 
 
-def ovals_from_yolo_output(
+def _read_yolo_output(
     labels_txt_path: pathlib.Path, 
     bounds: Tuple[float, float, float, float],
-) -> Tuple[List[int], List[shapely.geometry.Polygon]]:
+) -> Tuple[List[int], NDArray, NDArray, NDArray, NDArray]:
+    """Read a YOLO labels file into georeferenced box centres and sizes.
+
+    Returns the class ids and arrays of `x_center`, `y_center`, `width` and
+    `height` of the boxes, one entry per line of the file.
+    """
     width = bounds[2] - bounds[0]
     height = bounds[3] - bounds[1]
-    classes = []
-    polygons = []
-    with open(labels_txt_path, 'r') as file:
-        for line in file:
-            parts = line.strip().split()
-            class_id = int(parts[0])
-            x_center = bounds[0] + float(parts[1]) * width
-            y_center = bounds[3] - float(parts[2]) * height
-            box_width = float(parts[3]) * width
-            box_height = float(parts[4]) * height
-            center_point = shapely.geometry.Point(x_center, y_center)
-            unit_circle = center_point.buffer(1, resolution=4)
-            oval = shapely.affinity.scale(
-                unit_circle, box_width/2, box_height/2)
-            polygons.append(oval)
-            classes.append(class_id)
+    # Read the whole file at once; np.loadtxt would warn about empty files
+    text = pathlib.Path(labels_txt_path).read_text()
+    lines = [line for line in text.splitlines() if line.strip()]
+    if lines:
+        arr = np.loadtxt(lines, ndmin=2)
+    else:
+        arr = np.empty((0, 5))
+    classes = arr[:, 0].astype(int).tolist()
+    x_center = bounds[0] + arr[:, 1] * width
+    y_center = bounds[3] - arr[:, 2] * height
+    box_width = arr[:, 3] * width
+    box_height = arr[:, 4] * height
+    return classes, x_center, y_center, box_width, box_height
+
+
+def ovals_from_yolo_output(
+    labels_txt_path: pathlib.Path, 
+    bounds: Tuple[float, float, float, float],
+) -> Tuple[List[int], List[shapely.geometry.Polygon]]:
+    classes, x_center, y_center, box_width, box_height = (
+        _read_yolo_output(labels_txt_path, bounds))
+    # 16-gon, same vertex count as a point buffer with resolution 4
+    theta = np.linspace(0, 2 * np.pi, 17)[:-1]
+    xs = x_center[:, None] + (box_width[:, None] / 2) * np.cos(theta)
+    ys = y_center[:, None] + (box_height[:, None] / 2) * np.sin(theta)
+    polygons = shapely.polygons(np.stack([xs, ys], axis=-1)).tolist()
     return classes, polygons
 
 
@@ -126,26 +293,16 @@ def bboxes_from_yolo_output(
     labels_txt_path: pathlib.Path, 
     bounds: Tuple[float, float, float, float],
 ) -> Tuple[List[int], List[shapely.geometry.Polygon]]:
-    width = bounds[2] - bounds[0]
-    height = bounds[3] - bounds[1]
-    classes = []
-    polygons = []
-    with open(labels_txt_path, 'r') as file:
-        for line in file:
-            parts = line.strip().split()
-            class_id = int(parts[0])
-            x_center = bounds[0] + float(parts[1]) * width
-            y_center = bounds[3] - float(parts[2]) * height
-            box_width = float(parts[3]) * width
-            box_height = float(parts[4]) * height
-            x1 = x_center - box_width / 2
-            y1 = y_center - box_height / 2
-            x2 = x_center + box_width / 2
-            y2 = y_center + box_height / 2
-            polygons.append(shapely.geometry.Polygon(
-                [(x1, y1), (x1, y2), (x2, y2), (x2, y1)]
-            ))
-            classes.append(class_id)
+    classes, x_center, y_center, box_width, box_height = (
+        _read_yolo_output(labels_txt_path, bounds))
+    x1 = x_center - box_width / 2
+    y1 = y_center - box_height / 2
+    x2 = x_center + box_width / 2
+    y2 = y_center + box_height / 2
+    corners = np.stack(
+        [x1, y1, x1, y2, x2, y2, x2, y1], axis=1
+    ).reshape(-1, 4, 2)
+    polygons = shapely.polygons(corners).tolist()
     return classes, polygons
 
 
@@ -163,19 +320,45 @@ def convert_to_yolo_format(
     - class_id: Object class ID.
 
     Output:
-    - String in YOLO format (class_id, x_center, y_center, width, height).
+    - String in YOLO format (class_id, x_center, y_center, width, height),
+      see `convert_to_yolo_format_array`.
+    """
+    return convert_to_yolo_format_array(
+        np.array([object_bbox]), img_bbox, [class_id])[0]
+
+
+def convert_to_yolo_format_array(
+        object_bboxes: NDArray, 
+        img_bbox: tuple, 
+        class_ids: Sequence[Any],
+    ) -> List[str]:
+    """
+    Converts many axis aligned bounding boxes to YOLO format at once.
+
+    Input:
+    - object_bboxes: Array of object bounding boxes with shape (N, 4), each
+      row (min_x, min_y, max_x, max_y).
+    - img_bbox: Image bounding box (min_x, min_y, max_x, max_y).
+    - class_ids: Object class IDs, one per bounding box. Written as is, so
+      they can be e.g. integers or class names.
+
+    Output:
+    - List of strings in YOLO format (class_id, x_center, y_center, width,
+      height).
     """
-    obj_min_x, obj_min_y, obj_max_x, obj_max_y = object_bbox
+    object_bboxes = np.asarray(object_bboxes, dtype=float).reshape(-1, 4)
     img_min_x, img_min_y, img_max_x, img_max_y = img_bbox
     img_width = img_max_x - img_min_x
     img_height = img_max_y - img_min_y
-    obj_min_x_yolo = (obj_min_x - img_min_x) / img_width
-    obj_max_x_yolo = (obj_max_x - img_min_x) / img_width
-    obj_min_y_yolo = (img_max_y - obj_max_y) / img_height
-    obj_max_y_yolo = (img_max_y - obj_min_y) / img_height
-    x_center = (obj_min_x_yolo + obj_max_x_yolo) / 2.0
-    y_center = (obj_min_y_yolo + obj_max_y_yolo) / 2.0
-    width = obj_max_x_yolo - obj_min_x_yolo
-    height = obj_max_y_yolo - obj_min_y_yolo
-
-    return f"{class_id} {x_center} {y_center} {width} {height}"
\ No newline at end of file
+    obj_min_x, obj_min_y, obj_max_x, obj_max_y = object_bboxes.T
+    x_center = ((obj_min_x + obj_max_x) / 2.0 - img_min_x) / img_width
+    y_center = (img_max_y - (obj_min_y + obj_max_y) / 2.0) / img_height
+    width = (obj_max_x - obj_min_x) / img_width
+    height = (obj_max_y - obj_min_y) / img_height
+
+    # Coordinates stay a float array, the class ids are formatted separately
+    coords = np.column_stack([x_center, y_center, width, height]).tolist()
+    return [
+        f"{class_id} {x:.6f} {y:.6f} {w:.6f} {h:.6f}"
+        for class_id, (x, y, w, h) in zip(class_ids, coords)
+    ]